@@ -9,20 +9,26 @@ Autor: Esteban · Jun-2025 · MIT
 
 from __future__ import annotations
 
-import io
-import json
 import os
 import re
+import shutil
+import time
 import unicodedata
-import xml.etree.ElementTree as ET
-from datetime import timedelta, datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import time as dtime, timedelta, datetime
 from pathlib import Path
 from typing import Dict, List, Tuple
 from uuid import uuid4
 from zipfile import BadZipFile
 
 import openpyxl
+import orjson
 import pandas as pd
+import xlsxwriter
+from lxml import etree
+from openpyxl.packaging.relationship import get_rels_path
+from openpyxl.utils.cell import range_boundaries
 from flask import (
     Flask,
     flash,
@@ -35,7 +41,7 @@ from flask import (
     url_for,
 )
 from flask_session import Session
-from functools import wraps
+from functools import lru_cache, wraps
 
 # ────────────────────── Configuración Flask ──────────────────────────
 app = Flask(__name__)
@@ -53,28 +59,54 @@ MAPPINGS_DIR.mkdir(exist_ok=True)
 
 PROCESSED_DIR = Path("processed")
 PROCESSED_DIR.mkdir(exist_ok=True, parents=True)
-HISTORY_FILE = PROCESSED_DIR / "history.json"
+HISTORY_FILE = PROCESSED_DIR / "history.jsonl"  # un registro JSON por línea
+LEGACY_HISTORY_FILE = PROCESSED_DIR / "history.json"
+HISTORY_VIEW_LIMIT = 500
+
+# archivos subidos: se guardan en disco y la sesión sólo lleva la ruta
+UPLOADS_DIR = Path("uploads")
+UPLOADS_DIR.mkdir(mode=0o700, exist_ok=True)
+UPLOADS_PURGE_EVERY = 600  # segundos entre limpiezas de subidas abandonadas
+
+# unificaciones en segundo plano: el estado vive en PROCESSED_DIR
+EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv("UNIFY_WORKERS", "2")))
+JOB_ID_RE = re.compile(r"[0-9a-f]{32}")
+JOB_TIMEOUT = int(os.getenv("UNIFY_TIMEOUT", "1800"))  # segundos; luego se da por fallido
 
 # ───────────────────────── Utilidades base ───────────────────────────
+NON_ALNUM_RE = re.compile(r"[^a-z0-9]+")
+
+
+@lru_cache(maxsize=4096)
 def canonicalize(text: str) -> str:
     """Minúsculas sin tildes ni símbolos; separa con '_'."""
     text = text.strip().lower()
-    text = "".join(
-        c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c)
-    )
-    text = re.sub(r"[^a-z0-9]", "_", text)
-    return re.sub(r"__+", "_", text).strip("_")
+    if not text.isascii():  # ASCII puro no tiene tildes que quitar
+        text = "".join(
+            c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c)
+        )
+    return NON_ALNUM_RE.sub("_", text).strip("_")
 
 
 def slugify(name: str) -> str:
     return canonicalize(name) or "default"
 
 
+def resolve_header(orig: str, mapping: Dict[str, str]) -> str:
+    """Nombre final de un encabezado: clave original, luego canónica."""
+    dest = mapping.get(orig)
+    if dest is None:
+        canon = canonicalize(orig)
+        dest = mapping.get(canon, canon)
+    return dest
+
+
 def workbook_columns(wb: openpyxl.Workbook) -> Dict[str, List[str]]:
     """Devuelve los encabezados de cada hoja."""
     return {
         ws.title: [
-            c.value or f"col_{i+1}" for i, c in enumerate(next(ws.iter_rows(max_row=1)))
+            v or f"col_{i+1}"
+            for i, v in enumerate(next(ws.iter_rows(max_row=1, values_only=True)))
         ]
         for ws in wb.worksheets
     }
@@ -88,14 +120,14 @@ def list_mappings() -> List[str]:
 
 
 def save_mapping(name: str, mapping: Dict[str, str]) -> None:
-    (MAPPINGS_DIR / f"{slugify(name)}.json").write_text(
-        json.dumps(mapping, ensure_ascii=False, indent=2)
+    (MAPPINGS_DIR / f"{slugify(name)}.json").write_bytes(
+        orjson.dumps(mapping, option=orjson.OPT_INDENT_2)
     )
 
 
 def load_mapping(name: str) -> Dict[str, str]:
     p = MAPPINGS_DIR / f"{slugify(name)}.json"
-    return json.loads(p.read_text()) if p.exists() else {}
+    return orjson.loads(p.read_bytes()) if p.exists() else {}
 
 
 def delete_mapping(name: str) -> None:
@@ -116,120 +148,407 @@ def clone_mapping(src: str, dest: str) -> None:
     dest_p.write_bytes(src_p.read_bytes())
 
 
-def load_history() -> List[Dict[str, str]]:
+def migrate_history() -> None:
+    """
+    Convierte el antiguo history.json (una sola lista) a JSON Lines.
+    Puede correr a la vez en varios workers: nunca pisa history.jsonl y
+    el archivo antiguo se conserva como history.json.bak.
+    """
     if HISTORY_FILE.exists():
+        return
+    try:
+        records = orjson.loads(LEGACY_HISTORY_FILE.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):  # nada que migrar o ilegible
+        return
+    if not isinstance(records, list):
+        return
+
+    data = b"".join(orjson.dumps(r) + b"\n" for r in records)
+    tmp = HISTORY_FILE.with_name(f"{HISTORY_FILE.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    try:
+        os.link(tmp, HISTORY_FILE)  # atómico y sin sobrescribir
+    except FileExistsError:  # otro worker migró primero
+        pass
+    except OSError:  # sin enlaces duros: creación exclusiva
         try:
-            return json.loads(HISTORY_FILE.read_text())
-        except json.JSONDecodeError:
-            return []
-    return []
+            with HISTORY_FILE.open("xb") as f:
+                f.write(data)
+        except FileExistsError:  # otro worker migró primero
+            pass
+        except OSError:  # se conserva history.json para reintentar
+            app.logger.exception("No se pudo migrar el historial")
+            HISTORY_FILE.unlink(missing_ok=True)
+            return
+    finally:
+        tmp.unlink(missing_ok=True)
+    try:
+        LEGACY_HISTORY_FILE.replace(LEGACY_HISTORY_FILE.with_name("history.json.bak"))
+    except FileNotFoundError:
+        pass
+
+
+def load_history(limit: int | None = None) -> List[Dict[str, str]]:
+    """Registros del historial en orden; con ``limit`` sólo los últimos."""
+    if not HISTORY_FILE.exists():
+        return []
+    records: deque = deque(maxlen=limit)
+    with HISTORY_FILE.open("rb") as f:
+        for line in f:
+            try:
+                records.append(orjson.loads(line))
+            except orjson.JSONDecodeError:  # línea vacía o truncada
+                continue
+    return list(records)
 
 
 def add_history(mapping: str, filename: str) -> None:
-    records = load_history()
-    records.append({
+    record = {
         "mapping": mapping,
         "fecha": datetime.now().isoformat(timespec="seconds"),
         "archivo": filename,
-    })
-    HISTORY_FILE.write_text(json.dumps(records, ensure_ascii=False, indent=2))
+    }
+    with HISTORY_FILE.open("ab") as f:
+        f.write(orjson.dumps(record) + b"\n")
+
+
+migrate_history()  # al importar la app, antes de atender peticiones
+
+
+def session_uploads() -> List[Path]:
+    """Rutas de los archivos subidos en la sesión actual."""
+    paths = [Path(path) for _, path in session.get("files_xlsx", [])]
+    if session.get("file_xml"):
+        paths.append(Path(session["file_xml"]))
+    return paths
+
+
+def discard_uploads() -> None:
+    """Borra los archivos temporales subidos en la sesión actual."""
+    for path in session_uploads():
+        path.unlink(missing_ok=True)
+
+
+def touch_uploads() -> None:
+    """Marca las subidas de la sesión como en uso para que no se purguen."""
+    for path in session_uploads():
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+
+def upload_path(name: str) -> Path:
+    """Ruta para guardar una subida; recrea el directorio si desapareció."""
+    UPLOADS_DIR.mkdir(mode=0o700, exist_ok=True)
+    return UPLOADS_DIR / name
+
+
+def claim_uploads(job_id: str) -> Tuple[List[Tuple[str, str]], str | None]:
+    """
+    Da al trabajo su propia copia (enlace duro si se puede) de las subidas,
+    para que una nueva subida de la sesión no borre lo que está leyendo.
+    """
+    def claim(src: str, name: str) -> str:
+        dest = upload_path(name)
+        try:
+            os.link(src, dest)
+        except OSError:  # otro sistema de archivos
+            shutil.copyfile(src, dest)
+        return str(dest)
+
+    files = [
+        (name, claim(path, f"{job_id}_{i}.xlsx"))
+        for i, (name, path) in enumerate(session.get("files_xlsx", []))
+    ]
+    xml = session.get("file_xml")
+    return files, claim(xml, f"{job_id}.xml") if xml else None
 
 # ───────────────────────── Texto (flujo simbiu) ──────────────────────
-CODE_RE = re.compile(r"/(?:index/1|VerNoticia)/(\d+)")
-
-
-def build_text_df(xml_bytes: bytes) -> pd.DataFrame:
-    """Extrae código y texto completo del XML."""
-    root = ET.parse(io.BytesIO(xml_bytes)).getroot()
-    rows = []
-    for n in root.findall(".//noticia"):
-        url = n.findtext("Url_Noticia", "")
-        m = CODE_RE.search(url)
-        if m:
-            rows.append(
-                {
-                    "codigo": m.group(1),
-                    "texto": (n.findtext("FullText", "") or "").strip(),
-                }
-            )
-    return pd.DataFrame(rows).drop_duplicates("codigo")
-
-
-def add_text_column(df: pd.DataFrame, xml_bytes: bytes) -> pd.DataFrame:
+CODE_RE = re.compile(r"/(?:index/1|VerNoticia)/([0-9]+)", re.ASCII)
+
+
+def build_text_df(xml_path: str) -> pd.DataFrame:
+    """Extrae código y texto completo del XML (lectura incremental)."""
+    search = CODE_RE.search
+    texts: Dict[str, str] = {}  # código -> texto; prevalece la primera aparición
+    for _, n in etree.iterparse(str(xml_path), events=("end",), tag="noticia"):
+        url = n.findtext("Url_Noticia") or ""
+        m = search(url) if "/" in url else None
+        if m and m.group(1) not in texts:
+            texts[m.group(1)] = (n.findtext("FullText") or "").strip()
+        # liberar el nodo ya procesado y sus hermanos anteriores
+        n.clear()
+        while n.getprevious() is not None:
+            del n.getparent()[0]
+    return pd.DataFrame({"codigo": list(texts), "texto": list(texts.values())})
+
+
+def add_text_column(df: pd.DataFrame, xml_path: str | None) -> pd.DataFrame:
     """Une el texto del XML a la planilla (impresos / digitales)."""
-    if not xml_bytes:
+    if not xml_path:
         return df
 
     # localizar la columna con el enlace (case-insensitive)
     col_url = next(
         (c for c in df.columns if canonicalize(c) == "url_noticia"), None
     )
-    if col_url is None:
+    if col_url is None or df[col_url].fillna("").eq("").all():
         return df
 
-    text_df = build_text_df(xml_bytes)
-    df["codigo_link"] = df[col_url].astype(str).str.extract(CODE_RE, expand=False)
-    df = df.merge(text_df, left_on="codigo_link", right_on="codigo", how="left")
-    df.drop(columns=["codigo_link", "codigo"], inplace=True)
+    text_df = build_text_df(xml_path)
+    if text_df.empty:
+        return df
+    text_map = dict(zip(text_df["codigo"], text_df["texto"]))
+    # sin copia si la columna ya es de textos; si no, se convierte a str
+    try:
+        codes = df[col_url].str.extract(CODE_RE, expand=False)
+    except AttributeError:  # números, fechas u objetos sin textos
+        codes = df[col_url].astype(str).str.extract(CODE_RE, expand=False)
+    df["texto"] = codes.map(text_map)
     return df
 
 # ───────────────────────── Unificación de hojas ──────────────────────
-def unify_workbook(xlsx_bytes: bytes, mapping: Dict[str, str]) -> pd.DataFrame:
+SHEET_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+
+def sheet_hyperlinks(wb: openpyxl.Workbook, ws) -> Dict[Tuple[int, int], str]:
+    """
+    Hipervínculos de una hoja abierta en modo read_only: {(fila, col): url}.
+    openpyxl no los expone en ese modo, así que se leen del propio .xlsx.
+    """
+    archive = wb._archive
+    rels_path = get_rels_path(ws._worksheet_path)
+    if rels_path not in archive.namelist():
+        return {}
+    rels = etree.fromstring(archive.read(rels_path))
+    targets = {
+        rel.get("Id"): rel.get("Target")
+        for rel in rels.iter(f"{PKG_REL_NS}Relationship")
+        if rel.get("Type", "").endswith("/hyperlink")
+    }
+    if not targets:  # hoja sin vínculos externos: no se vuelve a leer
+        return {}
+
+    links: Dict[Tuple[int, int], str] = {}
+    with archive.open(ws._worksheet_path) as src:
+        tags = (f"{SHEET_NS}row", f"{SHEET_NS}hyperlink")
+        for _, el in etree.iterparse(src, events=("end",), tag=tags):
+            # sólo vínculos con relación externa; los internos no tienen URL
+            target = el.tag == tags[1] and targets.get(el.get(f"{REL_NS}id"))
+            if target:
+                min_col, min_row, max_col, max_row = range_boundaries(el.get("ref"))
+                for r in range(min_row, max_row + 1):
+                    for c in range(min_col, max_col + 1):
+                        links[(r, c)] = target
+            el.clear()
+            while el.getprevious() is not None:
+                del el.getparent()[0]
+    return links
+
+
+def link_cells(sheet: pd.DataFrame, links: Dict[Tuple[int, int], str]) -> None:
+    """Reemplaza por =HYPERLINK las celdas con vínculo (la fila 1 es el encabezado)."""
+    by_col: Dict[int, List[Tuple[int, str]]] = {}
+    for (r, c), target in links.items():
+        i, j = r - 2, c - 1
+        if 0 <= i < len(sheet) and 0 <= j < sheet.shape[1]:
+            by_col.setdefault(j, []).append((i, target))
+
+    # una lectura y una escritura por columna, no por celda
+    for j, cells in by_col.items():
+        values = sheet[j].to_numpy(dtype=object, copy=True)
+        rows = [i for i, _ in cells]
+        values[rows] = [
+            f'=HYPERLINK("{target}", "{target if pd.isna(values[i]) else values[i]}")'
+            for i, target in cells
+        ]
+        sheet[j] = values
+
+
+def link_urls(col: pd.Series) -> pd.Series:
+    """Convierte en fórmula =HYPERLINK las celdas de texto que son URL."""
+    try:
+        mask = col.str.startswith(("http://", "https://"), na=False)
+    except AttributeError:  # columna sin textos
+        return col
+    if not mask.any():
+        return col
+    urls = col[mask]
+    col = col.copy()
+    col[mask] = '=HYPERLINK("' + urls + '", "' + urls + '")'
+    return col
+
+
+def unify_workbook(xlsx_path: str, mapping: Dict[str, str]) -> pd.DataFrame:
     """
     Une todas las hojas del Excel normalizando encabezados.
     Devuelve DataFrame manteniendo los hipervínculos activos.
     """
     wb_in = openpyxl.load_workbook(
-        io.BytesIO(xlsx_bytes), read_only=True, data_only=False
+        xlsx_path, read_only=True, data_only=False, keep_links=False
     )
-    all_rows: List[List] = []
-    headers_final: List[str] = []
+    frames: List[pd.DataFrame] = []
+    headers_final: Dict[str, None] = {}  # conjunto ordenado de destinos
+    resolved: Dict[str, str] = {}
 
-    # ---- determinar encabezados finales --------------------------------
-    for ws in wb_in.worksheets:
-        for orig in next(ws.iter_rows(max_row=1, values_only=True)):
-            orig = orig or ""
-            dest = mapping.get(orig, mapping.get(canonicalize(orig), canonicalize(orig)))
-            if dest not in headers_final:
-                headers_final.append(dest)
+    def dest_for(orig: str) -> str:
+        """Nombre final de un encabezado; se resuelve una vez por libro."""
+        if orig not in resolved:
+            resolved[orig] = resolve_header(orig, mapping)
+        return resolved[orig]
 
-    # ---- recorrer filas y re-mapear ------------------------------------
+    # ---- una sola lectura por hoja: encabezados + filas ----------------
     for ws in wb_in.worksheets:
-        header_src = [c or "" for c in next(ws.iter_rows(max_row=1, values_only=True))]
-        idx2dest = {
-            idx: mapping.get(orig, mapping.get(canonicalize(orig), canonicalize(orig)))
-            for idx, orig in enumerate(header_src)
-        }
-        for row in ws.iter_rows(min_row=2, values_only=False):
-            new_row = [""] * len(headers_final)
-            for idx, cell in enumerate(row):
-                dest = idx2dest.get(idx)
-                if not dest:
-                    continue
-                link = getattr(cell, "hyperlink", None)
-                if link:
-                    value = f'=HYPERLINK("{link.target}", "{cell.value}")'
-                elif isinstance(cell.value, str) and re.match(r"https?://", cell.value):
-                    value = f'=HYPERLINK("{cell.value}", "{cell.value}")'
-                else:
-                    value = cell.value
-                new_row[headers_final.index(dest)] = value
-            all_rows.append(new_row)
-
-    df = pd.DataFrame(all_rows, columns=headers_final)
+        rows = ws.iter_rows(values_only=True)
+        idx2dest = [dest_for(orig or "") for orig in next(rows)]
+        headers_final.update(dict.fromkeys(idx2dest))
+
+        keep = [idx for idx, dest in enumerate(idx2dest) if dest]
+        sheet = pd.DataFrame(list(rows))
+        link_cells(sheet, sheet_hyperlinks(wb_in, ws))
+        sheet = sheet.reindex(columns=keep)
+        sheet.columns = [idx2dest[idx] for idx in keep]
+        # si dos columnas van al mismo destino, prevalece la última
+        frames.append(sheet.loc[:, ~sheet.columns.duplicated(keep="last")])
+
+    wb_in.close()
+    columns = list(headers_final)
+    if len(frames) == 1 and list(frames[0].columns) == columns:
+        df = frames[0]  # caso común: una sola hoja, nada que alinear
+    else:
+        df = pd.concat(
+            [sheet.reindex(columns=columns) for sheet in frames], ignore_index=True
+        )
+    for col in df.columns:
+        df[col] = link_urls(df[col])
     return df
 
 
-def unify_files(files: List[Tuple[str, bytes]], mapping: Dict[str, str]) -> pd.DataFrame:
-    """Une varias planillas y agrega la columna ``archivo_origen``."""
+def unify_files(files: List[Tuple[str, str]], mapping: Dict[str, str]) -> pd.DataFrame:
+    """
+    Une una o varias planillas; si son varias agrega la columna
+    ``archivo_origen``.
+    """
+    if not files:
+        return pd.DataFrame()
+    if len(files) == 1:
+        return unify_workbook(files[0][1], mapping)
+
     merged = []
-    for name, data in files:
-        df = unify_workbook(data, mapping)
+    for name, path in files:
+        df = unify_workbook(path, mapping)
         df["archivo_origen"] = Path(name).stem
         merged.append(df)
-    return pd.concat(merged, ignore_index=True) if merged else pd.DataFrame()
+    return pd.concat(merged, ignore_index=True, sort=False)
+
+
+def write_xlsx(df: pd.DataFrame, out) -> None:
+    """
+    Escribe el DataFrame fila a fila con xlsxwriter en modo constant_memory.
+    Las filas deben ir en orden: por eso no se usa ``df.to_excel``, que
+    escribe por columnas y en este modo perdería datos.
+    """
+    wb = xlsxwriter.Workbook(
+        out,
+        {
+            "constant_memory": True,
+            "strings_to_urls": False,  # las URL ya van como fórmula =HYPERLINK
+            "default_date_format": "yyyy-mm-dd hh:mm:ss",
+        },
+    )
+    # horas y duraciones no deben llevar el formato de fecha por defecto
+    time_fmts = {
+        dtime: wb.add_format({"num_format": "hh:mm:ss"}),
+        timedelta: wb.add_format({"num_format": "[h]:mm:ss"}),
+    }
+    ws = wb.add_worksheet("Unificado")
+    ws.write_row(0, 0, list(df.columns))
+    # NaN / NaT no son valores válidos para Excel: se dejan como celdas vacías
+    values = df.astype(object).where(df.notna(), None)
+    # sólo columnas object pueden traer horas sueltas; las timedelta64 se marcan directo
+    time_cols = [
+        c
+        for c, dtype in enumerate(df.dtypes)
+        if pd.api.types.is_timedelta64_dtype(dtype)
+        or (
+            dtype == object
+            and any(isinstance(v, (dtime, timedelta)) for v in df.iloc[:, c].to_numpy())
+        )
+    ]
+    for r, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        ws.write_row(r, 0, row)
+        for c in time_cols:
+            for kind, fmt in time_fmts.items():
+                if isinstance(row[c], kind):
+                    ws.write_datetime(r, c, row[c], fmt)
+    wb.close()
+
+
+def run_unify_job(
+    job_id: str,
+    files: List[Tuple[str, str]],
+    mapping: Dict[str, str],
+    mapping_name: str,
+    xml_path: str | None,
+) -> None:
+    """
+    Unifica en segundo plano. Deja ``<job_id>.xlsx`` en PROCESSED_DIR, o
+    ``<job_id>.error`` si falla, para que cualquier proceso vea el estado.
+    Al terminar borra sus entradas y la marca ``<job_id>.running``.
+    """
+    # se escribe con otro nombre y se renombra: el .xlsx sólo aparece completo
+    partial = PROCESSED_DIR / f"{job_id}.part"
+    try:
+        merged = unify_files(files, mapping)
+
+        # Añadir texto si es Simbiu
+        if mapping_name == "simbiu":
+            merged = add_text_column(merged, xml_path)
+
+        write_xlsx(merged, str(partial))
+        partial.replace(PROCESSED_DIR / f"{job_id}.xlsx")
+        add_history(mapping_name, f"{job_id}.xlsx")
+    except (BadZipFile, ValueError, Exception):
+        app.logger.exception("Error al unificar archivos")
+        partial.unlink(missing_ok=True)
+        (PROCESSED_DIR / f"{job_id}.error").touch()
+    finally:
+        for _, path in files:
+            Path(path).unlink(missing_ok=True)
+        if xml_path:
+            Path(xml_path).unlink(missing_ok=True)
+        (PROCESSED_DIR / f"{job_id}.running").unlink(missing_ok=True)
+
 
 # ────────────────────────────── Rutas ────────────────────────────────
+_last_purge = 0.0
+
+
+@app.before_request
+def purge_stale_uploads() -> None:
+    """
+    Borra subidas de sesiones abandonadas y restos de trabajos fallidos
+    (``.error``, ``.part``, ``.running``) más viejos que la sesión.
+    """
+    global _last_purge
+    now = time.time()
+    if now - _last_purge < UPLOADS_PURGE_EVERY:
+        return
+    _last_purge = now
+    cutoff = now - app.permanent_session_lifetime.total_seconds()
+    stale = [*UPLOADS_DIR.glob("*")]
+    for pattern in ("*.error", "*.part", "*.running"):
+        stale.extend(PROCESSED_DIR.glob(pattern))
+    for path in stale:
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except FileNotFoundError:  # otro proceso ya la borró
+            pass
+
 
 def login_required(view):
     """Wrapper sin verificación de sesión."""
@@ -263,15 +582,28 @@ def home():
             if not (f_xml and f_xml.filename.lower().endswith(".xml")):
                 flash("Para planillas Simbiu debes subir también el XML.", "danger")
                 return redirect(url_for("home"))
-            session["file_xml"] = f_xml.read()
 
-        # Guardar en sesión
-        session["files_xlsx"] = [(f.filename, f.read()) for f in files_xlsx]
+        # Guardar archivos en disco y sus rutas en sesión
+        discard_uploads()
+        session.pop("file_xml", None)
+        token = uuid4().hex
+        if mapping_choice == "simbiu":
+            xml_path = upload_path(f"{token}.xml")
+            f_xml.save(xml_path)
+            session["file_xml"] = str(xml_path)
+
+        uploads = []
+        for i, f in enumerate(files_xlsx):
+            path = upload_path(f"{token}_{i}.xlsx")
+            f.save(path)
+            uploads.append((f.filename, str(path)))
+        session["files_xlsx"] = uploads
         session["file_xlsx_name"] = Path(files_xlsx[0].filename).stem
         session["mapping_name"] = mapping_choice
 
-        wb = openpyxl.load_workbook(io.BytesIO(session["files_xlsx"][0][1]), read_only=True)
+        wb = openpyxl.load_workbook(uploads[0][1], read_only=True, keep_links=False)
         session["cols_per_sheet"] = workbook_columns(wb)
+        wb.close()
 
         return redirect(url_for("mapping"))
 
@@ -287,6 +619,7 @@ def mapping():
 
     if not cols_per_sheet:
         return redirect(url_for("home"))
+    touch_uploads()  # la sesión sigue usándolas
 
     if request.method == "POST":
         action = request.form.get("action", "unify")
@@ -303,51 +636,74 @@ def mapping():
             flash("Configuración guardada", "success")
             return redirect(url_for("mapping"))
 
+        # Unificación en segundo plano; el navegador espera en /estado
+        job_id = uuid4().hex
         try:
-            # Unificación
-            files_xlsx = session.get("files_xlsx", [])
-            if len(files_xlsx) > 1:
-                merged = unify_files(files_xlsx, mapping)
-            else:
-                merged = (
-                    unify_workbook(files_xlsx[0][1], mapping)
-                    if files_xlsx
-                    else pd.DataFrame()
-                )
-
-            # Añadir texto si es Simbiu
-            if mapping_name == "simbiu":
-                merged = add_text_column(merged, session.get("file_xml", b""))
-
-            out = io.BytesIO()
-            merged.to_excel(out, index=False)
-            out.seek(0)
-
-            filename = f"{uuid4().hex}.xlsx"
-            (PROCESSED_DIR / filename).write_bytes(out.getvalue())
-            add_history(mapping_name, filename)
-
-            out.seek(0)
-
-            base = session.get("file_xlsx_name", slugify(mapping_name))
-            session.clear()  # limpiamos todo
-            return send_file(
-                out,
-                as_attachment=True,
-                download_name=f"Unificado_{base}.xlsx",
-                mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-            )
-        except (BadZipFile, ValueError, Exception):
-            flash("Ocurrió un error al procesar los archivos", "danger")
-            app.logger.exception("Error al unificar archivos")
-            return redirect(url_for("mapping"))
+            files, xml_path = claim_uploads(job_id)
+        except FileNotFoundError:  # la subida expiró y se purgó
+            flash("Los archivos subidos expiraron; vuelve a subirlos", "danger")
+            return redirect(url_for("home"))
+        (PROCESSED_DIR / f"{job_id}.running").touch()
+        EXECUTOR.submit(run_unify_job, job_id, files, mapping, mapping_name, xml_path)
+        session["job_id"] = job_id
+        return redirect(url_for("job_status", job_id=job_id))
 
     return render_template_string(
         TPL_MAPPING,
         mapping_name=mapping_name,
         cols_per_sheet=cols_per_sheet,
         existing_mapping=load_mapping(mapping_name),
-        canonicalize=canonicalize,
+        resolve_header=resolve_header,
+    )
+
+
+@app.route("/estado/<job_id>")
+@login_required
+def job_status(job_id: str):
+    """
+    Espera la unificación; al terminar muestra una página de listo que
+    inicia la descarga (``?descargar=1``).
+    """
+    if not JOB_ID_RE.fullmatch(job_id):
+        return abort(404)
+
+    error = PROCESSED_DIR / f"{job_id}.error"
+    running = PROCESSED_DIR / f"{job_id}.running"
+    result = PROCESSED_DIR / f"{job_id}.xlsx"
+
+    # la marca se mira antes que el resultado: el trabajo la borra después
+    try:
+        alive = time.time() - running.stat().st_mtime < JOB_TIMEOUT
+    except FileNotFoundError:
+        alive = False
+
+    if not result.exists():
+        if session.get("job_id") != job_id:  # trabajo ajeno o inexistente
+            return abort(404)
+        if alive and not error.exists():
+            return render_template_string(TPL_ESTADO)
+        # falló, o el worker murió / no terminó a tiempo
+        if not error.exists():
+            app.logger.warning("Trabajo %s sin resultado tras %s s", job_id, JOB_TIMEOUT)
+        error.unlink(missing_ok=True)
+        running.unlink(missing_ok=True)
+        session.pop("job_id", None)
+        flash("Ocurrió un error al procesar los archivos", "danger")
+        return redirect(url_for("mapping"))
+
+    if not request.args.get("descargar"):
+        return render_template_string(
+            TPL_LISTO, download_url=url_for("job_status", job_id=job_id, descargar=1)
+        )
+
+    base = session.get("file_xlsx_name", job_id)
+    discard_uploads()
+    session.clear()  # limpiamos todo
+    return send_file(
+        result.resolve(),
+        as_attachment=True,
+        download_name=f"Unificado_{base}.xlsx",
+        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
     )
 
 
@@ -413,7 +769,7 @@ def download_processed(filename: str):
 @app.route("/historial")
 @login_required
 def historial():
-    records = load_history()[::-1]
+    records = load_history(HISTORY_VIEW_LIMIT)[::-1]
     return render_template_string(TPL_HISTORIAL, records=records)
 
 # ────────────────────────── Plantillas HTML ──────────────────────────
@@ -540,8 +896,7 @@ TPL_MAPPING = """
         <thead><tr><th>Columna original</th><th>Nombre final</th></tr></thead>
         <tbody>
         {% for col in cols %}
-          {% set canon = canonicalize(col) %}
-          {% set pre = existing_mapping.get(col, existing_mapping.get(canon, canon)) %}
+          {% set pre = resolve_header(col, existing_mapping) %}
           <tr>
             <td>{{ col }}</td>
             <td><input class="form-control form-control-sm" name="{{ col }}" value="{{ pre }}"></td>
@@ -559,6 +914,34 @@ TPL_MAPPING = """
 </div>
 """
 
+TPL_ESTADO = """
+<!doctype html>
+<title>Unificar Excel · Procesando</title>
+<meta http-equiv="refresh" content="2">
+<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css">
+
+<div class="container py-5">
+  <h2 class="mb-4">Procesando planillas…</h2>
+  <div class="spinner-border text-primary" role="status"></div>
+  <p class="mt-3">La descarga comenzará automáticamente cuando el archivo esté listo.</p>
+  <a href="{{ url_for('home') }}" class="btn btn-link">← Menú</a>
+</div>
+"""
+
+TPL_LISTO = """
+<!doctype html>
+<title>Unificar Excel · Listo</title>
+<meta http-equiv="refresh" content="0;url={{ download_url }}">
+<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css">
+
+<div class="container py-5">
+  <h2 class="mb-4">Archivo listo</h2>
+  <p>La descarga debería comenzar sola. Si no, usa el botón.</p>
+  <a href="{{ download_url }}" class="btn btn-success" style="width:200px">Descargar</a>
+  <a href="{{ url_for('home') }}" class="btn btn-link">← Menú</a>
+</div>
+"""
+
 TPL_HISTORIAL = """
 <!doctype html>
 <title>Historial de planillas</title>